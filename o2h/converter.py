@@ -1,5 +1,6 @@
+import concurrent.futures
+import functools
 import html
-import json
 import logging
 import os
 import pathlib
@@ -8,6 +9,7 @@ import shutil
 import urllib.parse
 
 import frontmatter
+import yaml
 from o2h.add_spaces import add_spaces_to_content
 from slugify import slugify
 from o2h.utils import (
@@ -19,6 +21,68 @@ from o2h.utils import (
     yield_subfolders,
 )
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# libyaml emitter when available, a lot faster than the pure python one
+_YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# wiki link [[file_path]] or markdown link, scanned together in one pass.
+# group 1 is the wiki link file path, group 2 is the markdown link uri.
+# starts with a literal "[" so the regex engine can search for it quickly,
+# an embedded markdown link is told by the "!" just before the match.
+# uris and wiki paths use negated classes, which stop at the same place as a
+# lazy .*? but need no backtracking. link text stays lazy, it may hold brackets,
+# but never runs over a "[[", so a wiki link is not swallowed as link text
+_LINK_RE = re.compile(r"\[(?:\[([^\]\n]*)\]\]|(?:(?!\[\[).)*?\]\(([^)\n]*)\))")
+
+# uri scheme (RFC 3986), links starting with one are external
+_SCHEME_RE = re.compile(r"[A-Za-z][A-Za-z0-9+.\-]*:")
+
+# workers for I/O bound jobs (copying attachments, writing posts)
+_IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# url quoting is pure, and the same uris repeat across a vault
+_quote = functools.lru_cache(maxsize=4096)(urllib.parse.quote)
+_unquote = functools.lru_cache(maxsize=4096)(urllib.parse.unquote)
+
+# below this number of notes, convert them in the main process
+_PROCESS_POOL_MIN_NOTES = 64
+
+_NOTE_EXTS = frozenset([".md", ".markdown"])
+_VIDEO_EXTS = frozenset([".mp4", ".webm", ".ogg"])
+_VIDEO_TAG_TEMPLATE = """
+<video controls style="width:100%; max-height:480px;border:1px solid #ccc;border-radius:5px;">
+    <source src="{uri}" type="video/mp4">
+</video>
+"""
+
+
+if tomllib:
+
+    class _TOMLHandler(frontmatter.default_handlers.BaseHandler):
+        """TOML front-matter, loaded by tomllib instead of the pure python toml"""
+
+        FM_BOUNDARY = re.compile(r"^\+{3,}\s*$", re.MULTILINE)
+        START_DELIMITER = END_DELIMITER = "+++"
+
+        def load(self, fm, **kwargs):
+            return tomllib.loads(fm)
+
+    _TOML_HANDLER = _TOMLHandler()
+else:
+    _TOML_HANDLER = None
+
 
 def handle(
     obsidian_vault_path: str,
@@ -44,24 +108,32 @@ def handle(
     # prepare exclude dirs
     excluded_dirname_patterns = [r"^\."]
     # excludes template folder
-    tmp_cfg_file = str(
-        pathlib.Path(obsidian_vault_path, ".obsidian/templates.json").absolute()
+    tmp_cfg_file = pathlib.Path(obsidian_vault_path, ".obsidian/templates.json")
+    try:
+        t = tmp_cfg_file.read_bytes()
+    except FileNotFoundError:  # templates plugin never configured
+        template_dirname = None
+    else:
+        template_dirname = _json_loads(t).get("folder")
+    if template_dirname:
+        excluded_dirname_patterns.append(f"^(?:{template_dirname})$")
+    # one regex for all patterns
+    excluded_dirname_re = re.compile(
+        "|".join(f"(?:{p})" for p in excluded_dirname_patterns)
     )
-    t = open(tmp_cfg_file).read()
-    template_dirname = json.loads(t).get("folder")
-    excluded_dirname_patterns.append(f"^(?:{template_dirname})$")
 
     # 2nd parse folders
     folders_map = _prepare_folder_map(
         obsidian_vault_path,
         hugo_project_path,
         folder_name_map,
-        excluded_dirname_patterns,
+        excluded_dirname_re,
     )
 
-    # 3rd parse notes
-    note_files_map, inline_links = _parse_obsidian_notes(
-        obsidian_vault_path, folders_map, excluded_dirname_patterns
+    # 3rd parse notes, each note is read only once
+    vault_files = _index_vault_files(obsidian_vault_path, excluded_dirname_re)
+    note_files_map, inline_links, parsed_notes = _parse_obsidian_notes(
+        obsidian_vault_path, folders_map, excluded_dirname_re, vault_files
     )
 
     if onoff_clean_dest_dirs:
@@ -79,6 +151,7 @@ def handle(
     # 5th generate hugo posts
     generate_hugo_posts(
         note_files_map,
+        parsed_notes,
         inline_links,
         obsidian_vault_path,
         hugo_project_path,
@@ -107,7 +180,7 @@ def _prepare_folder_map(
     obsidian_vault_path: str,
     hugo_project_path: str,
     folder_name_map: dict,
-    excluded_dirname_patterns: list,
+    excluded_dirname_re: re.Pattern,
 ):
     """folders_map = {src_note_folder:dest_post_folder}, absolute path"""
     folders = {}
@@ -122,7 +195,7 @@ def _prepare_folder_map(
     # else: all folders
     # add all sub folders
     for dirpath in yield_subfolders(
-        obsidian_vault_path, recursive=True, excludes=excluded_dirname_patterns
+        obsidian_vault_path, recursive=True, excludes=[excluded_dirname_re]
     ):
         src_abs_dirpath = os.path.abspath(dirpath)
         src_rel_dirpath = os.path.relpath(src_abs_dirpath, obsidian_vault_path)
@@ -136,105 +209,174 @@ def _prepare_folder_map(
     return folders
 
 
+@functools.lru_cache(maxsize=1024)
 def _slugify_rel_dirpath(rel_dirpath):
     """slugify relative dirpath"""
-    path_parts = rel_dirpath.split(os.sep)
-    path_parts = [slugify(add_spaces_to_content(p)) for p in path_parts]
-    return os.sep.join(path_parts)
+    return os.sep.join(_slug(p) for p in rel_dirpath.split(os.sep))
 
 
-def _parse_obsidian_notes(obsidian_vault_path, folders_map, excluded_dirname_patterns):
+@functools.lru_cache(maxsize=8192)
+def _slug(s: str):
+    """slugify with CJK spacing, cached since path parts repeat across notes"""
+    return slugify(add_spaces_to_content(s))
+
+
+def _index_vault_files(obsidian_vault_path, excluded_dirname_re):
+    """
+    Returns:
+    - vault_files = {normalized_path: exists}, all files in the vault
+      (excluded folders skipped), other paths are added when checked
+    """
+    vault_files = {}
+    for root, dirs, files in os.walk(obsidian_vault_path):
+        dirs[:] = [d for d in dirs if not excluded_dirname_re.search(d)]
+        for name in files:
+            vault_files[os.path.normpath(os.path.join(root, name))] = True
+    return vault_files
+
+
+def _path_exists(path, vault_files):
+    """look up the vault file index, stat a path not in it only once"""
+    # normpath drops "dir/.." without checking that dir exists, but the path is
+    # opened as it is later, stat such paths instead of normalizing them
+    path_key = path if ".." in path else os.path.normpath(path)
+    if path_key not in vault_files:
+        vault_files[path_key] = os.path.exists(path)
+    return vault_files[path_key]
+
+
+def _parse_obsidian_notes(
+    obsidian_vault_path, folders_map, excluded_dirname_re, vault_files
+):
     """
     Returns:
     - note_files_map = {note_abs_path:post_abs_path}
     - inline_links = {inline_uri: {"note_abs_path": abs_path, "type": "file|note"}}
+    - parsed_notes = {note_abs_path:(metadata, content)}
     """
     notes = {}
     inline_links = {}
+    parsed_notes = {}
 
     for note_folder, post_folder in folders_map.items():
+        # exclude dir patterns, once per folder
+        dn = os.path.basename(os.path.normpath(note_folder))
+        if excluded_dirname_re.search(dn):
+            continue
+
+        post_folder_prefix = os.path.join(post_folder, "")  # ends with a single os.sep
         for filepath in yield_files(note_folder, ext=[".md"], recursive=False):
             note_abs_path = os.path.join(note_folder, filepath)
-
-            # exclude dir patterns
-            dn = os.path.basename(os.path.dirname(note_abs_path))
-            if any([re.search(pat, dn) for pat in excluded_dirname_patterns]):
-                continue
-
-            # load post
-            note_raw = open(note_abs_path, "rt", encoding="utf-8").read()
-            try:
-                note = frontmatter.loads(note_raw)
-            except Exception as e:
-                logging.error(f"Failed to parse note: {filepath}\n\t{e}")
+            metadata, content, error = _load_note(note_abs_path)
+            if error:
+                logging.error(f"Failed to parse note: {filepath}\n\t{error}")
                 exit(1)
-            # note.metadata, note.content
+            # wiki links are converted to md links when the post is generated
             inline_links = extract_inline_links_of_post(
-                inline_links, obsidian_vault_path, note_folder, note.content, filepath
+                inline_links,
+                obsidian_vault_path,
+                note_folder,
+                content,
+                filepath,
+                vault_files,
             )
 
             # dest post path
-            post_slug = note.metadata.get("slug")
+            post_slug = metadata.get("slug")
             if not post_slug:
                 post_filename = os.path.splitext(os.path.basename(filepath))[0]
-                post_slug = slugify(add_spaces_to_content(post_filename))
+                post_slug = _slug(post_filename)
             post_filename = post_slug + ".md"
-            notes[note_abs_path] = os.path.join(post_folder, post_filename)
+            notes[note_abs_path] = post_folder_prefix + post_filename
+            # plain tuple, cheap to pickle for the conversion processes
+            parsed_notes[note_abs_path] = (metadata, content)
 
-    return notes, inline_links
+    return notes, inline_links, parsed_notes
+
+
+def _load_note(note_abs_path):
+    """
+    Returns:
+    - (metadata, content, None), or (None, None, error message) if not parsable
+    """
+    # bytes + decode skips the text layer's incremental decoder,
+    # newlines are translated by hand as text mode would do
+    note_raw = pathlib.Path(note_abs_path).read_bytes().decode("utf-8")
+    if "\r" in note_raw:
+        note_raw = note_raw.replace("\r\n", "\n").replace("\r", "\n")
+    handler = None
+    if _TOML_HANDLER and _TOML_HANDLER.detect(note_raw):
+        handler = _TOML_HANDLER
+    try:
+        note = frontmatter.loads(note_raw, handler=handler)
+    except Exception as e:
+        return None, None, str(e)
+    return note.metadata, note.content, None
 
 
 def extract_inline_links_of_post(
-    inline_links: dict, obsidian_vault_path, note_folder, note_content, note_filepath
+    inline_links: dict,
+    obsidian_vault_path,
+    note_folder,
+    note_content,
+    note_filepath,
+    vault_files: dict,
 ):
-    # convert wiki links to md links: [[file_path]] -> md [](file_path)
-    note_content = re.sub(r"\[\[(.*?)\]\]", r"\[\1\](\1)", note_content)
+    # every link has a "[", skip notes without any link
+    if "[" not in note_content:
+        return inline_links
+
+    # find wiki links and md links
+    seen_uris = set()  # external and broken links are not kept in inline_links
+    for m in _LINK_RE.finditer(note_content):
+        origin_uri = m.group(2) if m.group(1) is None else m.group(1)
+        if not origin_uri:
+            logging.warn(f"Found empty link in {note_filepath}")
+            continue
 
-    # find links
-    link_pattern = r"\[.*?\]\((.*?)\)"
-    for origin_uri in re.findall(link_pattern, note_content):
-        if origin_uri in inline_links:
+        if origin_uri in seen_uris:
             continue
+        seen_uris.add(origin_uri)
 
-        if not origin_uri:
-            logging.warn(f"Found empty link in {note_filepath}")
+        if _SCHEME_RE.match(origin_uri):  # ignore external links
             continue
 
-        if ":" in origin_uri:  # ignore external links
+        if origin_uri in inline_links:
             continue
 
         # convert anchor
         link = {}
-        parts = list(urllib.parse.urlsplit(origin_uri))
-        link["anchor"] = trans_url_anchor(parts[4])
+        uri_path, _, uri_anchor = origin_uri.partition("#")
+        link["anchor"] = trans_url_anchor(uri_anchor)
 
         if origin_uri.startswith("#"):  # only has anchor
             link["type"] = "anchor"
             link["dest"] = ""
-            inline_links.update({origin_uri: link})
+            inline_links[origin_uri] = link
             continue
 
-        unquoted_uri_path = urllib.parse.unquote(origin_uri.split("#")[0])
+        unquoted_uri_path = _unquote(uri_path)
         note_abs_path = os.path.join(obsidian_vault_path, unquoted_uri_path)
-        if not os.path.exists(note_abs_path):
+        if not _path_exists(note_abs_path, vault_files):
             note_abs_path = os.path.join(note_folder, unquoted_uri_path)
-        if not os.path.exists(note_abs_path):
+        if not _path_exists(note_abs_path, vault_files):
             logging.warn(f"Maybe not a uri or broken link: {origin_uri}")
             continue
             # raise ValueError(f"Can not solve the inline uri: {uri}")
         link["note_abs_path"] = note_abs_path
 
-        if os.path.splitext(note_abs_path)[1] in [".md", ".markdown"]:
+        if os.path.splitext(note_abs_path)[1] in _NOTE_EXTS:
             link["type"] = "note"
         else:
             link["type"] = "file"
-        inline_links.update({origin_uri: link})
+        inline_links[origin_uri] = link
 
     return inline_links
 
 
 def generate_hugo_posts(
     note_files_map,
+    parsed_notes,
     inline_links,
     obsidian_vault_path,
     hugo_project_path,
@@ -250,148 +392,253 @@ def generate_hugo_posts(
                 # use empty value to instead
                 note_files_map[note_abs_path] = None
 
-    count = 0
-    for note_abs_path, post_abs_path in note_files_map.items():
-        if not post_abs_path:  # be linked note that not be converted
-            continue
+    content_dir = os.path.join(hugo_project_path, "content")
+    attachment_rel_path = "/" + hugo_attachment_folder_name.strip("/") + "/"
+    inline_links = resolve_inline_links(
+        inline_links, note_files_map, content_dir, attachment_rel_path
+    )
 
-        count += 1
-        # read note
-        note_raw = open(note_abs_path, "r", encoding="utf-8").read()
-        note = frontmatter.loads(note_raw)
-
-        # prepare frontmatter. https://gohugo.io/content-management/front-matter/
-        metadata = note.metadata
-
-        title = metadata.get("title", "").strip()
-        if not title:
-            title = os.path.splitext(os.path.basename(note_abs_path))[0]
-            title = html.escape(title)
-        metadata["title"] = title
-
-        post_date = metadata.get("date")
-        if not post_date:
-            post_date = metadata.get("created")
-        if not post_date:
-            post_date = get_file_creation_time(note_abs_path)
-        if post_date:
-            metadata["date"] = post_date
-
-        last_mod = metadata.get("lastmod")
-        if not last_mod:
-            last_mod = metadata.get("updated")
-        if not last_mod:
-            last_mod = metadata.get("modified")
-        if not last_mod:
-            last_mod = get_file_modification_time(note_abs_path)
-        if last_mod:
-            metadata["lastmod"] = last_mod
-
-        metadata["tags"] = metadata.get("tags", [])
-
-        metadata, content = replace_inline_links(
-            metadata,
-            note.content,
-            inline_links,
-            note_files_map,
-            obsidian_vault_path,
-            hugo_project_path,
-            hugo_attachment_folder_name,
+    # create destination dirs once, posts mostly share them
+    for dest_dir in set(os.path.dirname(p) for p in note_files_map.values() if p):
+        os.makedirs(dest_dir, exist_ok=True)
+
+    # attachment uris may also be used in front-matter, find them in one regex
+    file_uris = [uri for uri in inline_links if inline_links[uri]["type"] == "file"]
+    file_uris_re = _compile_uris_re(file_uris)
+
+    # notes with the same slug share a post path, and would be written
+    # concurrently. keep the last one, as writing them in order used to do
+    post_notes = {p: n for n, p in note_files_map.items() if p}
+    tasks = [(n, p) for p, n in post_notes.items()]
+    note_paths = [note_abs_path for note_abs_path, _ in tasks]
+    notes = [parsed_notes[note_abs_path] for note_abs_path, _ in tasks]
+
+    # notes are independent of each other, convert them in parallel processes.
+    # for a few notes or a single cpu, starting the processes costs more than
+    # it saves
+    if (os.cpu_count() or 1) > 1 and len(tasks) >= _PROCESS_POOL_MIN_NOTES:
+        # the shared link tables go to each process once, not with every chunk
+        # default max_workers is the cpu count, capped on windows
+        with concurrent.futures.ProcessPoolExecutor(
+            initializer=_init_convert_process,
+            initargs=(inline_links, file_uris_re),
+        ) as executor:
+            outputs = executor.map(
+                _convert_note_in_process, note_paths, notes, chunksize=16
+            )
+            _write_posts(tasks, outputs)
+    else:
+        convert = functools.partial(
+            _convert_note,
+            inline_links=inline_links,
+            file_uris_re=file_uris_re,
         )
+        _write_posts(tasks, map(convert, note_paths, notes))
 
-        post = frontmatter.Post(content, **metadata)
-        output = frontmatter.dumps(post)
+    logging.info(f"Total {len(tasks)} notes converted.")
 
-        dest_dir = os.path.dirname(post_abs_path)
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir, exist_ok=True)
-        open(post_abs_path, "w", encoding="utf-8").write(output)
 
-    logging.info(f"Total {count} notes converted.")
+def _write_posts(tasks, outputs):
+    """
+    - tasks: [(note_abs_path, post_abs_path)]
+    - outputs: post text of each task, None means copy the note as it is
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_IO_WORKERS) as executor:
+        write_futures = []
+        for (note_abs_path, post_abs_path), output in zip(tasks, outputs):
+            if output is None:
+                write_futures.append(
+                    executor.submit(shutil.copyfile, note_abs_path, post_abs_path)
+                )
+            else:
+                write_futures.append(
+                    executor.submit(_write_post, output, post_abs_path)
+                )
 
+        # raise write errors, if any
+        for future in write_futures:
+            future.result()
 
-def replace_inline_links(
-    metadata,
-    content,
-    inline_links,
-    note_files_map,
-    obsidian_vault_path,
-    hugo_project_path,
-    hugo_attachment_folder_name,
-):
-    # - note_files_map = {note_abs_path:post_abs_path}
-    # - inline_links = {uri: {"type": "anchor|file|note", "note_abs_path": "src/file/"}}
 
-    # convert wiki links to md links: [[file_path]] -> md [](file_path)
-    content = re.sub(r"\[\[(.*?)\]\]", r"\[\1\](\1)", content)
+# arguments shared by all notes converted in a worker process
+_convert_process_kwargs = {}
 
-    content_dir = os.path.join(hugo_project_path, "content")
 
-    video_tag_template = """
-<video controls style="width:100%; max-height:480px;border:1px solid #ccc;border-radius:5px;">
-    <source src="{uri}" type="video/mp4">
-</video>
-"""
-    attachment_rel_path = "/" + hugo_attachment_folder_name.strip("/") + "/"
+def _init_convert_process(inline_links, file_uris_re):
+    """initializer of the conversion worker processes"""
+    _convert_process_kwargs["inline_links"] = inline_links
+    _convert_process_kwargs["file_uris_re"] = file_uris_re
 
+
+def _convert_note_in_process(note_abs_path, parsed_note):
+    return _convert_note(note_abs_path, parsed_note, **_convert_process_kwargs)
+
+
+def _convert_note(note_abs_path, parsed_note, inline_links, file_uris_re):
+    """render a note to hugo post text, or None if it can be used as it is"""
+
+    # prepare frontmatter. https://gohugo.io/content-management/front-matter/
+    metadata, content = parsed_note
+    updates = {}  # front-matter fields to set
+
+    title = metadata.get("title", "").strip()
+    if not title:
+        title = os.path.splitext(os.path.basename(note_abs_path))[0]
+        title = html.escape(title)
+    updates["title"] = title
+
+    stat_result = None  # stat the note at most once, and only if needed
+    post_date = metadata.get("date")
+    if not post_date:
+        post_date = metadata.get("created")
+    if not post_date:
+        stat_result = os.stat(note_abs_path)
+        post_date = get_file_creation_time(note_abs_path, stat_result)
+    if post_date:
+        updates["date"] = post_date
+
+    last_mod = metadata.get("lastmod")
+    if not last_mod:
+        last_mod = metadata.get("updated")
+    if not last_mod:
+        last_mod = metadata.get("modified")
+    if not last_mod:
+        if stat_result is None:
+            stat_result = os.stat(note_abs_path)
+        last_mod = get_file_modification_time(note_abs_path, stat_result)
+    if last_mod:
+        updates["lastmod"] = last_mod
+
+    updates["tags"] = metadata.get("tags", [])
+
+    # compare the few updated fields instead of copying the whole front-matter
+    is_complete = all(k in metadata and metadata[k] == v for k, v in updates.items())
+    metadata.update(updates)
+
+    # every wiki or md link has a "[", decided on the source content since
+    # rewritten links (e.g. video tags) may not look like links any more
+    has_links = "[" in content
+
+    new_metadata, content = replace_inline_links(
+        metadata, content, inline_links, file_uris_re
+    )
+
+    # no link in content, front-matter is complete and has no link to rewrite
+    # (the same dict is returned then), the note can be used as it is
+    if not has_links and is_complete and new_metadata is metadata:
+        return None
+
+    return _dump_post(new_metadata, content)
+
+
+def _dump_post(metadata, content):
+    """same layout as frontmatter.dumps, without building a Post"""
+    metadata_str = yaml.dump(
+        metadata, Dumper=_YAML_DUMPER, default_flow_style=False, allow_unicode=True
+    ).strip()
+    return f"---\n{metadata_str}\n---\n\n{content}".strip()
+
+
+def resolve_inline_links(
+    inline_links, note_files_map, content_dir, attachment_rel_path
+):
+    """resolve destination of every inline link once, before generating posts
+
+    - inline_links: {uri: {"dest_uri": "/dest#anchor", "video_tag_html": "" or None}}
+      and "attachment_uri" for file links
+    """
+    note_uris = {}  # {note_abs_path: quoted uri}, many uris link the same note
     for origin_uri in inline_links:
-        type_ = inline_links[origin_uri]["type"]
+        link = inline_links[origin_uri]
+        type_ = link["type"]
+        anchor = link["anchor"]
+        video_tag_html = None
         if type_ == "file":
-            dest_filename = inline_links[origin_uri]["dest_filename"]
-            dest_uri = attachment_rel_path + dest_filename
-            ext_name = os.path.splitext(dest_filename)[1]
-
-            # replace links in metadata
-            metadata = _replace_inline_links_in_var(metadata, origin_uri, dest_uri)
-
-            # replace links in content
-            if ext_name in [".mp4", ".webm", ".ogg"]:
-                # video, replace md link with html tag
-                pos = _find_md_link_pos(content, origin_uri)
-                if not pos:
-                    continue
-                pos_start, pos_end = pos
-                tag_html = video_tag_template.format(uri=dest_uri)
-                content = content[:pos_start] + tag_html + content[pos_end + 1 :]
-            else:
-                anchor = inline_links[origin_uri]["anchor"]
-                if anchor:
-                    dest_uri += f"#{anchor}"
-                content = content.replace(f"]({origin_uri})", f"]({dest_uri})")
-                continue
-
+            dest_uri = attachment_rel_path + link["dest_filename"]
+            link["attachment_uri"] = dest_uri
+            ext_name = os.path.splitext(link["dest_filename"])[1]
+            if ext_name in _VIDEO_EXTS:
+                video_tag_html = _VIDEO_TAG_TEMPLATE.format(uri=dest_uri)
+            if anchor:
+                dest_uri += f"#{anchor}"
         elif type_ == "anchor":
-            dest_uri = "#" + inline_links[origin_uri]["anchor"]
-            content = content.replace(f"]({origin_uri})", f"]({dest_uri})")
-            continue
+            dest_uri = "#" + anchor
         elif type_ == "note":
-            note_abs_path = inline_links[origin_uri]["note_abs_path"]
-            post_abs_path = note_files_map[note_abs_path]
-            if not post_abs_path:  # be linked note that not be converted
-                dest_uri = "#"
-            else:
-                dest_rel_path = os.path.relpath(post_abs_path, content_dir)
-                dest_uri = os.path.splitext(dest_rel_path)[0]
-                dest_uri = urllib.parse.quote(dest_uri)
+            note_abs_path = link["note_abs_path"]
+            dest_uri = note_uris.get(note_abs_path)
+            if dest_uri is None:
+                post_abs_path = note_files_map[note_abs_path]
+                if not post_abs_path:  # be linked note that not be converted
+                    dest_uri = "#"
+                else:
+                    dest_rel_path = os.path.relpath(post_abs_path, content_dir)
+                    dest_uri = os.path.splitext(dest_rel_path)[0]
+                    dest_uri = _quote(dest_uri)
+                note_uris[note_abs_path] = dest_uri
 
-            anchor = inline_links[origin_uri]["anchor"]
             if anchor:
                 dest_uri += f"#{anchor}"
-            content = content.replace(f"]({origin_uri})", f"](/{dest_uri})")
-            continue
+            dest_uri = "/" + dest_uri
         else:
             raise ValueError(f"Unknown type: {type_}")
+        link["dest_uri"] = dest_uri
+        link["video_tag_html"] = video_tag_html
+
+    return inline_links
+
+
+def _write_post(output, post_abs_path):
+    pathlib.Path(post_abs_path).write_bytes(output.encode("utf-8"))
+
+
+def replace_inline_links(metadata, content, inline_links, file_uris_re):
+    # - inline_links = {uri: {"type": "anchor|file|note", "dest_uri": "/dest#anchor"}}
+    # - file_uris_re, matches uris of file links, None if there is no file link
+
+    # replace links in metadata
+    if file_uris_re:
+        metadata = _replace_inline_links_in_var(
+            metadata,
+            file_uris_re,
+            lambda m: inline_links[m.group(0)]["attachment_uri"],
+        )
+
+    # replace links in content, in one pass
+    if "[" in content:  # no link otherwise, see extract_inline_links_of_post
+        content = _replace_links_in_content(content, inline_links)
 
     return metadata, content
 
 
-def _find_md_link_pos(content, uri):
-    pos = content.find(f"]({uri}")
-    if pos == -1:
-        return None
-    pos_end = content.find(")", pos)
-    pos_start = content.rfind("![", 0, pos)
-    return (pos_start, pos_end)
+def _replace_links_in_content(content, inline_links):
+    """convert wiki links to md links and rewrite link destinations"""
+    parts = []
+    pos = 0  # end of the last match
+    for m in _LINK_RE.finditer(content):
+        start = m.start()
+        wiki_uri = m.group(1)
+        if wiki_uri is not None:
+            # convert wiki link to md link: [[file_path]] -> \[file_path\](dest)
+            link = inline_links.get(wiki_uri)
+            dest_uri = link["dest_uri"] if link else wiki_uri
+            replacement = f"\\[{wiki_uri}\\]({dest_uri})"
+        else:
+            link = inline_links.get(m.group(2))
+            if not link:
+                continue
+            if link["video_tag_html"] and start > pos and content[start - 1] == "!":
+                # embedded video, replace md link and its "!" with html tag
+                start -= 1
+                replacement = link["video_tag_html"]
+            else:
+                replacement = content[start : m.start(2)] + link["dest_uri"] + ")"
+        parts.append(content[pos:start])
+        parts.append(replacement)
+        pos = m.end()
+    if not parts:
+        return content
+    parts.append(content[pos:])
+    return "".join(parts)
 
 
 def copy_attachments(
@@ -412,28 +659,73 @@ def copy_attachments(
 
     logging.info("Coping attachments ...")
 
+    dest_dir_prefix = os.path.join(dest_dir, "")  # ends with a single os.sep
+    dest_filenames = {}  # {src_path: dest_filename}, a file may have many uris
+    md5s = {}  # {src_path: md5}
+    if onoff_md5_attachment:
+        # hashing releases the GIL, hash all attachments concurrently
+        src_paths = {
+            item["note_abs_path"]
+            for item in inline_links.values()
+            if item["type"] == "file"
+        }
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_IO_WORKERS) as executor:
+            md5s = dict(zip(src_paths, executor.map(calc_file_md5, src_paths)))
+    copy_jobs = {}  # {dest_path: src_path}
     for uri in inline_links:
         item = inline_links[uri]
         if item["type"] != "file":
             continue
         src_path = item["note_abs_path"]
+        if src_path in dest_filenames:
+            inline_links[uri]["dest_filename"] = dest_filenames[src_path]
+            continue
+
         file_name, ext_name = os.path.splitext(os.path.basename(src_path))
         if onoff_md5_attachment:
-            dest_filename = calc_file_md5(src_path) + ext_name
+            dest_filename = md5s[src_path] + ext_name
         else:
             file_rel_path_in_vault = os.path.relpath(src_path, obsidian_vault_path)
             rel_path = os.path.dirname(file_rel_path_in_vault)
-            slug_filename = slugify(add_spaces_to_content(rel_path + "-" + file_name))
+            slug_filename = _slug(rel_path + "-" + file_name)
             dest_filename = slug_filename + ext_name
-        dest_path = os.path.join(dest_dir, dest_filename)
+        dest_path = dest_dir_prefix + dest_filename
+        dest_filenames[src_path] = dest_filename
+        inline_links[uri]["dest_filename"] = dest_filename
 
-        shutil.copyfile(src_path, dest_path)
+        # md5 named file already there, is the same file
+        if (
+            onoff_md5_attachment
+            and os.path.exists(dest_path)
+            and os.path.getsize(dest_path) == os.path.getsize(src_path)
+        ):
+            continue
+        copy_jobs[dest_path] = src_path
 
-        inline_links[uri]["dest_filename"] = dest_filename
+    # copying is pure I/O, overlap it with threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_IO_WORKERS) as executor:
+        list(executor.map(_copy_file, copy_jobs.values(), copy_jobs.keys()))
 
     return inline_links
 
 
+def _copy_file(src_path, dest_path):
+    """copy with copy_file_range where available (reflinks on btrfs/xfs)"""
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src_path, "rb") as fsrc, open(dest_path, "wb") as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                while size > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size)
+                    if copied == 0:  # e.g. pseudo files, fall back below
+                        raise OSError("copy_file_range copied nothing")
+                    size -= copied
+            return
+        except OSError:
+            pass  # not supported here, copy the usual way
+    shutil.copyfile(src_path, dest_path)
+
+
 def clean_up_dest_dirs(hugo_project_path, folders_map, hugo_attachment_folder_name):
     logging.info("Cleaning up destination directories ...")
     # folders_map = {src_note_folder:dest_post_folder}
@@ -453,37 +745,54 @@ def clean_up_dest_dirs(hugo_project_path, folders_map, hugo_attachment_folder_na
             continue
 
         logging.info(f"Cleaning directory: {dirpath} ...")
-        for file in pathlib.Path(dirpath).rglob("*"):
-            if file.is_dir():
-                continue
-            if file.name.startswith("_index."):
-                continue  # avoid custom index page
-            # delete the file
-            file.unlink(True)
-
-
+        for root, dirs, files in os.walk(dirpath):
+            for name in files:
+                if name.startswith("_index."):
+                    continue  # avoid custom index page
+                # delete the file
+                try:
+                    os.unlink(os.path.join(root, name))
+                except FileNotFoundError:
+                    pass
+
+
+@functools.lru_cache(maxsize=4096)
 def trans_url_anchor(url_anchor: str):
     url_anchor = url_anchor.strip().lower()
     if not url_anchor:
         return ""
 
-    s = urllib.parse.unquote(url_anchor).replace(" ", "-")
-    return urllib.parse.quote(s)
+    s = _unquote(url_anchor).replace(" ", "-")
+    return _quote(s)
+
+
+def _compile_uris_re(uris):
+    """one regex matching any of the uris, longest first. None if no uris"""
+    if not uris:
+        return None
+    uris = sorted(uris, key=len, reverse=True)
+    return re.compile("|".join(re.escape(uri) for uri in uris))
 
 
-def _replace_inline_links_in_var(var: any, origin_uri: str, dest_uri: str):
+def _replace_inline_links_in_var(var: any, uris_re: re.Pattern, repl):
+    """replace all uris in strings of var in one pass, containers are only
+    rebuilt when something in them changed"""
     if isinstance(var, str):
-        return var.replace(origin_uri, dest_uri)
+        return uris_re.sub(repl, var)
     elif isinstance(var, list):
-        return [
-            _replace_inline_links_in_var(item, origin_uri, dest_uri) for item in var
-        ]
+        new_var = [_replace_inline_links_in_var(item, uris_re, repl) for item in var]
+        if all(a is b for a, b in zip(new_var, var)):
+            return var
+        return new_var
     elif isinstance(var, dict):
-        return {
+        new_var = {
             _replace_inline_links_in_var(
-                k, origin_uri, dest_uri
-            ): _replace_inline_links_in_var(v, origin_uri, dest_uri)
+                k, uris_re, repl
+            ): _replace_inline_links_in_var(v, uris_re, repl)
             for k, v in var.items()
         }
+        if all(a is b and new_var[a] is v for a, (b, v) in zip(new_var, var.items())):
+            return var
+        return new_var
     else:
         return var
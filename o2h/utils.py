@@ -2,27 +2,51 @@ import datetime
 import hashlib
 import html.parser
 import itertools
+import mmap
 import os
 import re
 import sys
 import time
 
-
-def calc_file_md5(file_path: str):
-    with open(file_path, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+_MD5_CHUNK_SIZE = 1 << 20
+_MD5_MMAP_MIN_SIZE = 16 << 20
 
 
-def get_file_creation_time(file_path):
+def calc_file_md5(file_path: str):
+    """md5 hex digest, read in chunks so large files (videos) are not loaded
+    whole. hashlib releases the GIL, so it can be called from threads"""
+    h = hashlib.md5()
+    with open(file_path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= _MD5_MMAP_MIN_SIZE:
+            # hash straight from the page cache, no user-space copy
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+            return h.hexdigest()
+        while True:
+            chunk = f.read(_MD5_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_file_creation_time(file_path, stat_result: os.stat_result = None):
+    """stat_result, optional, result of os.stat(file_path) to reuse"""
+    if stat_result is None:
+        stat_result = os.stat(file_path)
     if sys.platform.startswith("win"):
-        t = os.path.getctime(file_path)
+        t = stat_result.st_ctime
     else:
-        t = os.stat(file_path).st_birthtime
+        t = stat_result.st_birthtime
     return format_time(t, format_template="%Y-%m-%d", show_utc=False)
 
 
-def get_file_modification_time(file_path):
-    t = os.path.getmtime(file_path)
+def get_file_modification_time(file_path, stat_result: os.stat_result = None):
+    """stat_result, optional, result of os.stat(file_path) to reuse"""
+    if stat_result is None:
+        stat_result = os.stat(file_path)
+    t = stat_result.st_mtime
     return format_time(t, format_template="%Y-%m-%d", show_utc=False)
 
 
@@ -127,6 +151,13 @@ class ImgSrcParser(html.parser.HTMLParser):
                 self.imgs = itertools.chain(self.imgs, [value])
 
 
+def _compile_patterns(patterns: list):
+    """regexp pattern strings to compiled patterns, compiled ones are kept as is"""
+    if not patterns:
+        return patterns
+    return [re.compile(pat) for pat in patterns]
+
+
 def yield_subfolders(dir_path: str, recursive: bool = True, excludes: list = None):
     """
     Args:
@@ -138,6 +169,8 @@ def yield_subfolders(dir_path: str, recursive: bool = True, excludes: list = Non
         - How to get relative path of a folder: os.path.relpath(subfolder_path, dir_path)
         - How to get absolute path of a folder: os.path.join(dir_path, subfolder_path)
     """
+    # compile once, subfolders get the compiled patterns
+    excludes = _compile_patterns(excludes)
     for f in os.scandir(dir_path):
         if not f.is_dir():
             continue
@@ -146,7 +179,7 @@ def yield_subfolders(dir_path: str, recursive: bool = True, excludes: list = Non
             # matching dir name
             is_ignore = False
             for pat in excludes:
-                if re.search(pat, f.name):
+                if pat.search(f.name):
                     is_ignore = True
                     break
             if is_ignore:
@@ -187,11 +220,13 @@ def yield_files(
         if not isinstance(ext, list):
             raise TypeError("ext must be a list or None")
 
+    # compile once, subfolders get the compiled patterns
+    excludes = _compile_patterns(excludes)
     for f in os.scandir(dir):
         if excludes:
             is_ignore = False
             for pat in excludes:
-                if re.search(pat, f.name):
+                if pat.search(f.name):
                     is_ignore = True
                     break
             if is_ignore: